@@ -6,11 +6,15 @@ from abc import ABC
 from argparse import (Action, ArgumentParser, ArgumentDefaultsHelpFormatter,
                       RawDescriptionHelpFormatter)
 from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
-from functools import lru_cache
+import copy
+import fnmatch
+from functools import lru_cache, wraps
 import hashlib
+import importlib.metadata
 from io import StringIO
-from itertools import repeat
+from itertools import chain
 import json
 import logging
 import os
@@ -19,10 +23,12 @@ import re
 import shlex
 import shutil
 import subprocess
-from subprocess import CalledProcessError, PIPE
+from subprocess import CalledProcessError, DEVNULL, PIPE
 import sys
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 import textwrap
+import threading
+import time
 import urllib.request
 
 import pkg_resources
@@ -41,11 +47,21 @@ except (ImportError, LookupError):
 
 LOGGER = logging.getLogger(Path(__file__).stem)
 
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or "~/.cache",
+                 "pypi2pkgbuild").expanduser()
+# Seconds during which cached versioned PyPI JSON is used without revalidation.
+PYPI_CACHE_MAX_AGE = 60 * 60
+PKGFILE_CONF = Path("/etc/pkgfile/pkgfile.conf")
+
 PY_TAGS = ["py{0.major}".format(sys.version_info),
            "cp{0.major}".format(sys.version_info),
            "py{0.major}{0.minor}".format(sys.version_info),
            "cp{0.major}{0.minor}".format(sys.version_info)]
 THIS_ARCH = ["i686", "x86_64"][sys.maxsize > 2 ** 32]
+SITE_PACKAGES_LOCATION = (
+    "{0.prefix}/lib/python{0.version_info.major}.{0.version_info.minor}"
+    "/site-packages".format(sys))
+SDIST_SUFFIXES = [".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar", ".zip"]
 LICENSE_NAMES = ["LICENSE", "LICENSE.txt", "license.txt",
                  "COPYING", "COPYING.md", "COPYING.rst", "COPYING.txt",
                  "COPYRIGHT"]
@@ -114,6 +130,19 @@ TROVE_SPECIAL_LICENSES = {  # Standard licenses with specific line.
         "Python",
 }
 
+ARCH_VERSION_RE = re.compile(r"(?:(.*):)?(.*)-(.*)")
+PEP503_SEPARATORS_RE = re.compile(r"[-_.]+")
+# namcap messages are prefixed by the package name, which we don't need to
+# check as namcap is only ever run on a single package at once.
+NAMCAP_EXTRA_DEPS_RE = re.compile(
+    r"(?<=E: Dependency ).*(?= detected and not included)")
+NAMCAP_ANY_ARCH_RE = re.compile(r"E: ELF file .* found in an 'any' package\.")
+# Package name has no dash (per packaging standard) nor slashes (which can
+# occur when a subpackage is vendored (depending on how it is done), e.g.
+# `.../foo.egg-info` and `.../foo/bar.egg-info` both existing).
+PKGFILE_EGG_INFO_RE = re.compile(
+    r"(?<=site-packages/)[^-/]*(?=.*\.egg-info/?$)")
+
 PKGBUILD_HEADER = """\
 # Maintainer: {config[PACKAGER]}
 
@@ -133,7 +162,7 @@ depends=(python {pkg.depends:{pkg.__class__.__name__}})
 makedepends=({pkg.makedepends:{pkg.__class__.__name__}})
 checkdepends=({pkg.checkdepends:{pkg.__class__.__name__}})
 provides=({pkg.provides})
-conflicts=(${{provides%=*}})  # No quotes, to avoid an empty entry.
+conflicts=({pkg.conflicts})
 source=(PKGBUILD_EXTRAS)
 md5sums=(SKIP)
 noextract=()
@@ -183,6 +212,7 @@ if [[ _is_wheel &&
 fi
 
 _dist_name() {
+    ## DIST_NAME ##
     find "$srcdir" -mindepth 1 -maxdepth 1 -type d -printf '%f\n' |
         grep -v '^_tmpenv$'
 }
@@ -272,6 +302,11 @@ makedepends=($(printf '%s\\n' "${makedepends[@]}" |
              grep -Pwv "^($(IFS='|'; echo "${depends[*]}"))$"))
 """
 
+# Shortcut for `_dist_name`, if the unpacked source name can be guessed.
+DIST_NAME_SHORTCUT = """\
+    if [[ -d "$srcdir"/{dist_name} ]]; then echo {dist_name}; return; fi
+"""
+
 METAPKGBUILD_CONTENTS = """\
 package() {
     true
@@ -280,8 +315,71 @@ package() {
 
 
 def _unique(seq):
-    """Return unique elements in a sequence, keeping them in order."""
-    return list(OrderedDict(zip(list(seq)[::-1], repeat(None))))[::-1]
+    """
+    Return unique elements in a sequence, keeping them in order.
+
+    Each element is positioned according to its last occurrence.
+    """
+    unique = {}
+    for elem in seq:
+        unique.pop(elem, None)  # Move repeated elements to the end.
+        unique[elem] = None
+    return list(unique)
+
+
+def _locked_cache(func):
+    """
+    Thread-safe variant of `lru_cache()`.
+
+    Concurrent calls with the same arguments wait for the first one to complete
+    instead of duplicating the work.
+    """
+    cached = lru_cache()(func)
+    locks = {}
+    locks_lock = threading.Lock()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = args, frozenset(kwargs.items())
+        with locks_lock:
+            lock = locks.setdefault(key, threading.RLock())
+        with lock:
+            return cached(*args, **kwargs)
+
+    return wrapper
+
+
+def _map_concurrently(func, iterable):
+    """Like `map`, but run the calls in a thread pool and return a list."""
+    args = list(iterable)
+    if len(args) <= 1:
+        return list(map(func, args))
+    with ThreadPoolExecutor(max_workers=min(8, len(args))) as executor:
+        return list(executor.map(func, args))
+
+
+# Each level of the dependency tree uses its own pool (a shared one would
+# deadlock, as parents wait for their children), so the number of threads is
+# unbounded.  Bound the number of concurrent builds (venv installs, makepkg and
+# namcap runs) instead.  Never hold this while waiting for other builds.
+_build_semaphore = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+
+# `urlparse` is called repeatedly on the same URLs; its results are immutable.
+_urlparse = lru_cache(maxsize=512)(urllib.parse.urlparse)
+
+
+def _write_bytes_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file = NamedTemporaryFile(dir=path.parent, delete=False)
+    try:
+        with file:
+            file.write(data)
+        os.replace(file.name, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(file.name)
+        raise
 
 
 def _run_shell(args, **kwargs):
@@ -304,6 +402,10 @@ def _run_shell(args, **kwargs):
                       **kwargs.pop("env", {})},
               "check": True,
               "text": True,
+              # File descriptors opened by Python are non-inheritable anyways
+              # (PEP446), so skip closing them all in the child (which also
+              # allows subprocess to use posix_spawn, when possible).
+              "close_fds": False,
               **kwargs}
     if "cwd" in kwargs:
         kwargs["cwd"] = str(Path(kwargs["cwd"]))
@@ -324,8 +426,35 @@ def _run_shell(args, **kwargs):
     return cproc
 
 
-@lru_cache()
+def _get_makepkg_conf_key():
+    # What the makepkg configuration depends on: the modification times of the
+    # config files, the environment variables overriding them, and our own
+    # version (which determines what gets probed).
+    paths = [
+        Path(os.environ.get("MAKEPKG_CONF") or "/etc/makepkg.conf"),
+        *sorted(Path("/etc/makepkg.conf.d").glob("*.conf")),
+        Path(os.environ.get("XDG_CONFIG_HOME") or "~/.config",
+             "pacman/makepkg.conf").expanduser(),
+        Path("~/.makepkg.conf").expanduser()]
+    mtimes = []
+    for path in paths:
+        with suppress(FileNotFoundError):
+            mtimes.append([str(path), path.stat().st_mtime_ns])
+    return {"version": __version__,
+            "mtimes": mtimes,
+            "env": {var: os.environ.get(var)
+                    for var in ["CARCH", "PACKAGER", "PKGDEST", "PKGEXT"]}}
+
+
+@_locked_cache
 def get_makepkg_conf():
+    # Probing makepkg is slow, so the result is also cached on disk.
+    cache_path = CACHE_DIR / "makepkg_conf.json"
+    key = _get_makepkg_conf_key()
+    with suppress(OSError, KeyError, TypeError, ValueError):
+        cached = json.loads(cache_path.read_text())
+        if cached["key"] == key:
+            return cached["conf"]
     with TemporaryDirectory() as tmpdir:
         mini_pkgbuild = textwrap.dedent(r"""
             pkgname=_
@@ -333,26 +462,36 @@ def get_makepkg_conf():
             pkgrel=0
             arch=(any)
             prepare() {
-                printf "CFLAGS %s\0CXXFLAGS %s\0PACKAGER %s" \
-                    "$CFLAGS" "$CXXFLAGS" "$PACKAGER" > log.txt
+                # PKGDEST defaults to $startdir, reported as empty.
+                [[ $PKGDEST != "$startdir" ]] || PKGDEST=
+                printf "%s %s\0" \
+                    CFLAGS "$CFLAGS" CXXFLAGS "$CXXFLAGS" \
+                    PACKAGER "$PACKAGER" CARCH "$CARCH" \
+                    PKGDEST "$PKGDEST" PKGEXT "$PKGEXT" > log.txt
                 exit 0
             }
         """)
         Path(tmpdir, "PKGBUILD").write_text(mini_pkgbuild)
         try:
-            _run_shell("makepkg", cwd=tmpdir, stdout=PIPE, stderr=PIPE)
+            _run_shell(["makepkg"], cwd=tmpdir, stdout=PIPE, stderr=PIPE)
         except CalledProcessError as e:
             sys.stderr.write(e.stderr)
             raise
         out = Path(tmpdir, "src/log.txt").read_text()
-    return dict(pair.split(" ", 1) for pair in out.split("\0"))
+    conf = dict(pair.split(" ", 1) for pair in out.split("\0") if pair)
+    try:  # Caching is best-effort.
+        _write_bytes_atomic(
+            cache_path,
+            json.dumps({"key": key, "conf": conf}).encode("utf-8"))
+    except OSError as exc:
+        LOGGER.debug("Failed to cache %s: %s", cache_path, exc)
+    return conf
 
 
 class ArchVersion(namedtuple("_ArchVersion", "epoch pkgver pkgrel")):
     @classmethod
     def parse(cls, s):
-        epoch, pkgver, pkgrel = (
-            re.fullmatch(r"(?:(.*):)?(.*)-(.*)", s).groups())
+        epoch, pkgver, pkgrel = ARCH_VERSION_RE.fullmatch(s).groups()
         return cls(epoch or "", pkgver, pkgrel)
 
     def __str__(self):
@@ -364,7 +503,7 @@ class WheelInfo(
         namedtuple("_WheelInfo", "name version build pythons abi platform")):
     @classmethod
     def parse(cls, url):
-        parts = Path(urllib.parse.urlparse(url).path).stem.split("-")
+        parts = Path(_urlparse(url).path).stem.split("-")
         if len(parts) == 5:
             name, version, pythons, abi, platform = parts
             build = ""
@@ -382,7 +521,7 @@ class WheelInfo(
 
 # Copy-pasted from PEP503.
 def pep503_normalize_name(name):
-    return re.sub(r"[-_.]+", "-", name).lower()
+    return PEP503_SEPARATORS_RE.sub("-", name).lower()
 
 
 def to_wheel_name(pep503_name):
@@ -415,10 +554,10 @@ def _vcs_get_url_rev(url):
     return url, rev
 
 
-@lru_cache()
+@_locked_cache
 def _get_url_impl(url):
     cache_dir = TemporaryDirectory()
-    parsed = urllib.parse.urlparse(url)
+    parsed = _urlparse(url)
     if parsed.scheme.startswith("git+"):
         _run_shell(["git", "clone", "--recursive", url[4:]],
                    cwd=cache_dir.name)
@@ -433,8 +572,10 @@ def _get_url_impl(url):
             raise PackagingError(f"Failed to download {parsed.netloc}, "
                                  "possibly due to a buggy setup.py")
     else:
-        Path(cache_dir.name, Path(parsed.path).name).write_bytes(
-            urllib.request.urlopen(url).read())
+        # Stream to disk rather than loading possibly large sdists in memory.
+        with urllib.request.urlopen(url) as r, \
+             Path(cache_dir.name, Path(parsed.path).name).open("wb") as file:
+            shutil.copyfileobj(r, file, 1 << 20)
     packed_path, = (path for path in Path(cache_dir.name).iterdir())
     # Keep a reference to the TemporaryDirectory.
     return cache_dir, packed_path
@@ -445,9 +586,9 @@ def _get_url_packed_path(url):
     return packed_path
 
 
-@lru_cache()
+@_locked_cache
 def _get_url_unpacked_path_or_null(url):
-    parsed = urllib.parse.urlparse(url)
+    parsed = _urlparse(url)
     if parsed.scheme == "file" and parsed.path.endswith(".whl"):
         return Path("/dev/null")
     try:
@@ -461,20 +602,61 @@ def _get_url_unpacked_path_or_null(url):
     return unpacked_path
 
 
-@lru_cache()
+@_locked_cache
 def _guess_url_makedepends(url, guess_makedepends):
     makedepends = [PackageRef("pip"), PackageRef("wheel")]
-    if ("swig" in guess_makedepends
-            and list(_get_url_unpacked_path_or_null(url).glob("**/*.i"))):
+    # Only download the source (and walk it, once) if needed.
+    suffixes = (
+        {path.suffix
+         for path in _get_url_unpacked_path_or_null(url).rglob("*")}
+        if {"swig", "cython"}.intersection(guess_makedepends) else set())
+    if "swig" in guess_makedepends and ".i" in suffixes:
         makedepends.append(NonPyPackageRef("swig"))
-    if ("cython" in guess_makedepends
-            and list(_get_url_unpacked_path_or_null(url).glob("**/*.pyx"))):
+    if "cython" in guess_makedepends and ".pyx" in suffixes:
         makedepends.append(PackageRef("Cython"))
     return DependsTuple(makedepends)
 
 
-@lru_cache()
+def _get_installed_metadata(name):
+    """
+    Return the metadata of a requirement that is already satisfied system-wide.
+
+    The metadata is in the same format as for `_get_metadata`; None is returned
+    if the requirement is not satisfied (or is an URL).
+    """
+    if _urlparse(name).scheme:
+        return None
+    try:
+        req = pkg_resources.Requirement.parse(name)
+    except ValueError:
+        return None
+    dist = next(importlib.metadata.distributions(
+        name=req.name, path=[SITE_PACKAGES_LOCATION]), None)
+    if (dist is None
+            or not req.specifier.contains(dist.version, prereleases=True)):
+        return None
+    metadata = dist.metadata
+    # Like `pip show`, evaluate markers without any extra.
+    requires = {
+        dep.name for dep in map(pkg_resources.Requirement.parse,
+                                dist.requires or [])
+        if not dep.marker or dep.marker.evaluate({"extra": ""})}
+    return {"name": metadata["Name"],
+            "version": dist.version,
+            "summary": metadata.get("Summary", ""),
+            "home_page": metadata.get("Home-page", ""),
+            "license": metadata.get("License", ""),
+            "classifiers": metadata.get_all("Classifier", []),
+            "requires": sorted(requires, key=str.lower)}
+
+
+@_locked_cache
 def _get_metadata(name, setup_requires):
+    # Already installed packages are directly introspected.
+    installed_metadata = _get_installed_metadata(name)
+    if installed_metadata:
+        LOGGER.debug("Using installed metadata for %s.", name)
+        return installed_metadata
     # Dependency resolution is done by installing the package in a venv and
     # calling `pip show`; otherwise it would be necessary to parse environment
     # markers (from "requires_dist").  The package name may get denormalized
@@ -485,73 +667,90 @@ def _get_metadata(name, setup_requires):
     #
     # To handle sdists that depend on numpy, we just see whether installing in
     # presence of numpy makes things better...
-    with TemporaryDirectory() as venvdir, \
-         NamedTemporaryFile("r") as more_requires_log, \
-         NamedTemporaryFile("r") as log:
-        script = textwrap.dedent(r"""
-            set -e
-            python -mvenv {venvdir}
-            # Leave the source directory, which may contain wheels/sdists/etc.
-            cd {venvdir}
-            . '{venvdir}/bin/activate'
-            pip install --upgrade {setup_requires} >/dev/null
-            install_cmd() {{
-                pip freeze | cut -d= -f1 | sort >'{venvdir}/pre_install_list'
-                if ! pip install --no-deps '{req}'; then
-                    return 1
-                fi
-                pip freeze | cut -d= -f1 | sort >'{venvdir}/post_install_list'
-                # installed name, or real name if it doesn't appear
-                # (setuptools, pip, Cython, numpy).
-                install_name="$(comm -13 '{venvdir}/pre_install_list' \
-                                         '{venvdir}/post_install_list')"
-                # the requirement can be 'req_name==version', or a path name.
-                if [[ -z "$install_name" ]]; then
-                    if [[ -e '{req}' ]]; then
-                        install_name="$(basename '{req}' .git)"
-                    else
-                        install_name="$(echo '{req}' | cut -d= -f1 -)"
-                    fi
-                fi
-            }}
-            show_cmd() {{
-                python - "$(pip show -v "$install_name")" <<EOF
+    #
+    # Everything but the venv creation is done by a single Python driver
+    # running in the venv, rather than by a shell script spawning `pip freeze`,
+    # `cut`, `sort`, `comm`, etc.
+    with TemporaryDirectory() as venvdir, NamedTemporaryFile("r") as log:
+        driver = textwrap.dedent(r"""
             from email.parser import Parser
+            import importlib.metadata
             import json
+            import os
+            import subprocess
             import sys
-            print(json.dumps(dict(Parser().parsestr(sys.argv[1]))))
-            EOF
-            }}
-            if install_cmd >{log.name}; then
-                show_cmd
-            else
-                pip install numpy >/dev/null
-                echo numpy >>{more_requires_log.name}
-                install_cmd >{log.name}
-                show_cmd
-            fi
-        """).format(
-            venvdir=venvdir,
-            setup_requires=" ".join(setup_requires),
-            req=(_get_url_unpacked_path_or_null(name)
-                 if name.startswith("git+") else name),
-            more_requires_log=more_requires_log,
-            log=log)
+
+            req, log_path, *setup_requires = sys.argv[1:]
+
+            def pip(*args, **kwargs):
+                return subprocess.run([sys.executable, "-mpip", *args],
+                                      universal_newlines=True, **kwargs)
+
+            def get_installed():
+                return {dist.metadata["Name"]
+                        for dist in importlib.metadata.distributions()}
+
+            def install():
+                pre_install = get_installed()
+                with open(log_path, "w") as log:
+                    if pip("install", "--no-deps", req, stdout=log).returncode:
+                        return None
+                # Installed name, or real name if it doesn't appear
+                # (setuptools, pip, Cython, numpy).  The requirement can be
+                # 'req_name==version', or a path name.
+                for install_name in get_installed() - pre_install:
+                    return install_name
+                if os.path.exists(req):
+                    name = os.path.basename(req)
+                    return (name[:-len(".git")] if name.endswith(".git")
+                            else name)
+                else:
+                    return req.split("=")[0]
+
+            if setup_requires:
+                pip("install", "--upgrade", *setup_requires,
+                    stdout=subprocess.DEVNULL, check=True)
+            more_requires = []
+            install_name = install()
+            if install_name is None:
+                pip("install", "numpy", stdout=subprocess.DEVNULL, check=True)
+                more_requires.append("numpy")
+                install_name = install()
+                if install_name is None:
+                    sys.exit(1)
+            show = pip("show", "-v", install_name,
+                       stdout=subprocess.PIPE, check=True).stdout
+            print(json.dumps({"metadata": dict(Parser().parsestr(show)),
+                              "more_requires": more_requires}))
+        """)
+        req = (_get_url_unpacked_path_or_null(name)
+               if name.startswith("git+") else name)
         try:
-            process = _run_shell(
-                script, stdout=PIPE, env={
-                    # Matters, as a built wheel would get cached.
-                    "CFLAGS": get_makepkg_conf()["CFLAGS"],
-                    # Not actually used, per pypa/setuptools#1192.  Still
-                    # relevant for packages that ship their own autoconf-based
-                    # builds, e.g. wxPython.
-                    "CXXFLAGS": get_makepkg_conf()["CXXFLAGS"],
-                })
+            with _build_semaphore:
+                _run_shell(["python", "-mvenv", venvdir])
+                process = _run_shell(
+                    [f"{venvdir}/bin/python", "-c", driver,
+                     req, log.name, *setup_requires],
+                    # Leave the source directory, which may contain
+                    # wheels/sdists/etc.
+                    cwd=venvdir,
+                    stdout=PIPE, env={
+                        # Same as sourcing bin/activate.
+                        "PATH": f"{venvdir}/bin:{os.environ['PATH']}",
+                        "VIRTUAL_ENV": venvdir,
+                        # Matters, as a built wheel would get cached.
+                        "CFLAGS": get_makepkg_conf()["CFLAGS"],
+                        # Not actually used, per pypa/setuptools#1192.
+                        # Still relevant for packages that ship their own
+                        # autoconf-based builds, e.g. wxPython.
+                        "CXXFLAGS": get_makepkg_conf()["CXXFLAGS"],
+                    })
         except CalledProcessError:
             sys.stderr.write(log.read())
             raise PackagingError(f"Failed to obtain metadata for {name}.")
-        more_requires = more_requires_log.read().splitlines()
-    metadata = {k.lower(): v for k, v in json.loads(process.stdout).items()}
+    output = json.loads(process.stdout)
+    more_requires = output["more_requires"]
+    metadata = {k.lower(): v for k, v in output["metadata"].items()}
     metadata["requires"] = [
         *(metadata["requires"].split(", ") if metadata["requires"] else []),
         *more_requires]
@@ -559,14 +758,61 @@ def _get_metadata(name, setup_requires):
     return {key.replace("-", "_"): value for key, value in metadata.items()}
 
 
-@lru_cache()
+def _fetch_pypi_json(name, version):
+    """
+    Fetch the PyPI JSON API for a package (and version, if non-empty).
+
+    Responses are cached on disk.  Recent versioned responses are served
+    directly from the cache; other ones are revalidated using their ETag.
+    """
+    url = (f"https://pypi.org/pypi/{name}/{version}/json" if version
+           else f"https://pypi.org/pypi/{name}/json")
+    cache_path = Path(CACHE_DIR, "pypi", pep503_normalize_name(name),
+                      f"{version or 'latest'}.json")
+    # Versioned responses still change when e.g. wheels are uploaded after the
+    # sdist or a release is yanked, so only trust them for a limited time.
+    with suppress(FileNotFoundError):
+        if (version and time.time() - cache_path.stat().st_mtime
+                < PYPI_CACHE_MAX_AGE):
+            LOGGER.debug("Using cached %s.", cache_path)
+            return cache_path.read_bytes()
+    etag_path = cache_path.with_suffix(".etag")
+    request = urllib.request.Request(url)
+    if cache_path.exists() and etag_path.exists():
+        request.add_header("If-None-Match", etag_path.read_text())
+    try:
+        with urllib.request.urlopen(request) as r:
+            contents = r.read()
+            etag = r.headers.get("ETag")
+    except urllib.error.HTTPError as exc:
+        if exc.code == 304:  # Not Modified.
+            LOGGER.debug("Using cached %s.", cache_path)
+            # Restart the clock for serving it without revalidation.
+            with suppress(OSError):
+                cache_path.touch()
+            return cache_path.read_bytes()
+        raise
+    # Drop the old ETag first and write the new one last, so that it never
+    # refers to stale contents.  Caching is best-effort.
+    try:
+        with suppress(FileNotFoundError):
+            etag_path.unlink()
+        _write_bytes_atomic(cache_path, contents)
+        if etag:
+            _write_bytes_atomic(etag_path, etag.encode("ascii"))
+    except OSError as exc:
+        LOGGER.debug("Failed to cache %s: %s", url, exc)
+    return contents
+
+
+@_locked_cache
 def _get_info(name, *,
               pre=False,
               guess_makedepends=(),
               _sources=("git", "local", "pypi"),
               _version=""):
 
-    parsed = urllib.parse.urlparse(name)
+    parsed = _urlparse(name)
 
     def _get_info_git():
         if not parsed.scheme.startswith("git+"):
@@ -612,14 +858,12 @@ def _get_info(name, *,
 
     def _get_info_pypi():
         try:
-            r = urllib.request.urlopen(
-                f"https://pypi.org/pypi/{name}/{_version}/json"
-                if _version else f"https://pypi.org/pypi/{name}/json")
+            contents = _fetch_pypi_json(name, _version)
         except urllib.error.HTTPError:
             return
         # Load as OrderedDict so that always the same sdist is chosen if e.g.
         # both zip and tgz are available.
-        request = json.loads(r.read(), object_pairs_hook=OrderedDict)
+        request = json.loads(contents, object_pairs_hook=OrderedDict)
         if not _version:
             versions = [
                 version for version in map(pkg_resources.parse_version,
@@ -645,12 +889,6 @@ def _get_info(name, *,
             " ".join(filter(None, [name, _version]))))
 
 
-def _get_site_packages_location():
-    return (
-        "{0.prefix}/lib/python{0.version_info.major}.{0.version_info.minor}"
-        "/site-packages".format(sys))
-
-
 # For _find_{installed,arch}_name_version:
 #   - first check for a matching `.{dist,egg}-info` file, ignoring case to
 #     handle e.g. `cycler` (pip) / `Cycler` (PyPI).
@@ -659,15 +897,24 @@ def _get_site_packages_location():
 
 
 def _find_installed_name_version(pep503_name, *, ignore_vendored=False):
-    parts = (
-        _run_shell(
-            "(shopt -s nocaseglob; pacman -Qo {}/{}-*-info 2>/dev/null) | "
-            "rev | cut -d' ' -f1,2 | rev".format(
-                _get_site_packages_location(), to_wheel_name(pep503_name)),
-            stdout=PIPE).stdout.split()
-        or _run_shell(
-            f"pacman -Q python-{pep503_name} 2>/dev/null",
-            stdout=PIPE, check=False).stdout.split())
+    # Case-insensitive equivalent of `{wheel_name}-*-info`.
+    info_pattern = f"{to_wheel_name(pep503_name)}-*-info"
+    info_paths = [
+        path for path in Path(SITE_PACKAGES_LOCATION).iterdir()
+        if fnmatch.fnmatchcase(path.name.lower(), info_pattern)]
+    parts = []
+    if info_paths:
+        parts = [
+            # "$path is owned by $pkgname $version"
+            part
+            for line in _run_shell(
+                ["pacman", "-Qo", *info_paths],
+                stdout=PIPE, stderr=DEVNULL, check=False).stdout.splitlines()
+            for part in line.split()[-2:]]
+    if not parts:
+        parts = _run_shell(
+            ["pacman", "-Q", f"python-{pep503_name}"],
+            stdout=PIPE, stderr=DEVNULL, check=False).stdout.split()
     if parts:
         pkgname, version = parts  # This will raise if there is an ambiguity.
         if pkgname.endswith("-git"):
@@ -690,17 +937,30 @@ def _find_installed_name_version(pep503_name, *, ignore_vendored=False):
         return
 
 
+def _get_pkgfile_cache_dir():
+    cache_dir = "/var/cache/pkgfile"  # pkgfile's default CachePath.
+    with suppress(FileNotFoundError):
+        for line in PKGFILE_CONF.read_text().splitlines():
+            key, sep, value = line.partition("=")
+            if sep and key.strip() == "CachePath":  # Skips commented lines.
+                cache_dir = value.strip()
+    return Path(cache_dir)
+
+
 def _find_arch_name_version(pep503_name):
     for standalone in [True, False]:  # vendored into another Python package?
-        *candidates, = map(str.strip, _run_shell(
-            "pkgfile -riv "
-            "'^/usr/lib/python{version.major}\.{version.minor}/{parent}"
-            r"{wheel_name}-.*py{version.major}\.{version.minor}\.egg-info' | "
-            "cut -f1 | uniq | cut -d/ -f2".format(
-                parent="site-packages/" if standalone else "",
-                wheel_name=to_wheel_name(pep503_name),
-                version=sys.version_info),
-            stdout=PIPE).stdout.splitlines())
+        # "$repo/$pkgname $version\t$path", deduplicated.
+        *candidates, = dict.fromkeys(
+            line.split("\t")[0].split("/")[1].strip()
+            for line in _run_shell(
+                ["pkgfile", "-riv",
+                 r"^/usr/lib/python{version.major}\.{version.minor}/{parent}"
+                 r"{wheel_name}-.*py{version.major}\.{version.minor}"
+                 r"\.egg-info".format(
+                     parent="site-packages/" if standalone else "",
+                     wheel_name=to_wheel_name(pep503_name),
+                     version=sys.version_info)],
+                stdout=PIPE, check=False).stdout.splitlines())
         if len(candidates) > 1:
             message = "Multiple candidates for {}: {}.".format(
                 pep503_name, ", ".join(candidates))
@@ -764,14 +1024,14 @@ class PackageRef:
             pkgname, arch_version = installed or arch or default
             depname, _ = arch or installed or default
 
-        arch_packaged = sorted({*_run_shell(
-            "pkgfile -l {} 2>/dev/null | "
-            # Package name has no dash (per packaging standard) nor slashes
-            # (which can occur when a subpackage is vendored (depending on how
-            # it is done), e.g. `.../foo.egg-info` and `.../foo/bar.egg-info`
-            # both existing).
-            r"grep -Po '(?<=site-packages/)[^-/]*(?=.*\.egg-info/?$)'".
-            format(pkgname), stdout=PIPE, check=False).stdout.splitlines()})
+        arch_packaged = sorted({
+            match.group(0)
+            for match in map(
+                PKGFILE_EGG_INFO_RE.search,
+                _run_shell(["pkgfile", "-l", pkgname],
+                           stdout=PIPE, stderr=DEVNULL, check=False)
+                .stdout.splitlines())
+            if match and match.group(0)})
 
         # Final values.
         self.pkgname = (
@@ -811,13 +1071,56 @@ BuildCacheEntry = namedtuple(
     "BuildCacheEntry", "pkgname path is_dep namcap_report")
 
 
+def _get_package_path(srcinfo, conf, cwd):
+    """
+    Compute the path of a package built in *cwd*, from its .SRCINFO and the
+    makepkg configuration *conf*.
+
+    This follows makepkg's naming, ``$PKGDEST/$pkgname-$fullver-$arch$PKGEXT``
+    (as ``makepkg --packagelist`` would).
+    """
+    fields = {}
+    for line in srcinfo.splitlines():
+        key, sep, value = line.strip().partition(" = ")
+        if sep:
+            fields.setdefault(key, []).append(value)
+    epoch, = fields.get("epoch", ["0"])
+    pkgver, = fields["pkgver"]
+    pkgrel, = fields["pkgrel"]
+    # Only the first arch matters, as in makepkg's `get_pkg_arch`.
+    arch = "any" if fields["arch"][0] == "any" else conf["CARCH"]
+    # This may be absolute and not in cwd (if PKGDEST is set).
+    return Path(
+        conf["PKGDEST"] or cwd,
+        "{}-{}-{}{}".format(
+            fields["pkgname"][0],
+            ArchVersion(epoch if epoch != "0" else "", pkgver, pkgrel),
+            arch,
+            conf["PKGEXT"]))
+
+
 class _BasePackage(ABC):
     build_cache = []
+    _build_cache_lock = threading.Lock()
 
     def __init__(self):
         self._files = OrderedDict()
+        self._file_sources = None  # Computed lazily, reset by `_add_file`.
         # self._pkgbuild = ...
 
+    def _add_file(self, fname, content):
+        self._files[fname] = content
+        self._file_sources = None
+
+    def _get_file_sources(self):
+        """Return the quoted names and the md5sums of the extra files."""
+        if self._file_sources is None:
+            self._file_sources = (
+                [shlex.quote(fname) for fname in self._files],
+                [hashlib.md5(content).hexdigest()
+                 for content in self._files.values()])
+        return self._file_sources
+
     @abc.abstractmethod
     def write_deps_to(self, options):
         pass
@@ -850,52 +1153,59 @@ class _BasePackage(ABC):
                 else:
                     dest.unlink()
             shutil.move(srctree, dest)
+        with _build_semaphore:
+            fullpath, namcap_report = self._build(options, cwd)
+        with type(self)._build_cache_lock:
+            type(self).build_cache.append(BuildCacheEntry(
+                self.pkgname, fullpath, options.is_dep, namcap_report))
+        # FIXME Suppress message about redundancy of 'python' dependency.
+
+    def _build(self, options, cwd):
+        """Run makepkg and namcap; return the package path and report."""
         cmd = ["makepkg",
                *(["--force"] if options.force else []),
                *shlex.split(options.makepkg)]
         _run_shell(cmd, cwd=cwd)
 
         def _get_fullpath():
-            # This may be absolute and not in cwd (if PKGDEST is set).
-            return Path(_run_shell("makepkg --packagelist",
-                                   cwd=cwd, stdout=PIPE).stdout)
+            # Write .SRCINFO, and compute the package path from it (as
+            # `makepkg --packagelist` would, but without yet another makepkg
+            # invocation).
+            srcinfo = _run_shell(["makepkg", "--printsrcinfo"],
+                                 cwd=cwd, stdout=PIPE).stdout
+            (cwd / ".SRCINFO").write_text(srcinfo + "\n")
+            return _get_package_path(srcinfo, get_makepkg_conf(), cwd)
 
         fullpath = _get_fullpath()
-        # Update PKGBUILD.
-        needs_rebuild = False
-        namcap = (_run_shell(["namcap", fullpath], cwd=cwd, stdout=PIPE)
-                  .stdout.splitlines())
-        # `pkgver()` may update the PKGBUILD, so reread it.
-        pkgbuild_contents = (cwd / "PKGBUILD").read_text()
+        # The regexes do not span newlines, so there is no need to split the
+        # output into lines.
+        namcap = _run_shell(["namcap", fullpath], cwd=cwd, stdout=PIPE).stdout
         # Binary dependencies.
-        extra_deps_re = (f"(?<=^{self.pkgname} "
-                         "E: Dependency ).*(?= detected and not included)")
-        extra_deps = [
-            match.group(0)
-            for match in map(re.compile(extra_deps_re).search, namcap)
-            if match]
-        pkgbuild_contents = pkgbuild_contents.replace(
-            "## EXTRA_DEPENDS ##",
-            "depends+=({})".format(" ".join(extra_deps)))
-        if extra_deps:
-            needs_rebuild = True
+        extra_deps = NAMCAP_EXTRA_DEPS_RE.findall(namcap)
         # Unexpected arch-dependent package (e.g. direct compilation of C
         # source).
-        any_arch_re = (f"^{self.pkgname} "
-                       "E: ELF file .* found in an 'any' package.")
-        if any(re.search(any_arch_re, line) for line in namcap):
-            pkgbuild_contents = re.sub(
-                "(?m)^arch=.*$", f"arch=({THIS_ARCH})", pkgbuild_contents, 1)
-            needs_rebuild = True
-        if needs_rebuild:
+        wrong_arch = bool(NAMCAP_ANY_ARCH_RE.search(namcap))
+        # Update PKGBUILD, only if needed (the EXTRA_DEPENDS marker is
+        # otherwise left as a comment).
+        if extra_deps or wrong_arch:
+            # `pkgver()` may update the PKGBUILD, so reread it.
+            pkgbuild_contents = (cwd / "PKGBUILD").read_text()
+            pkgbuild_contents = pkgbuild_contents.replace(
+                "## EXTRA_DEPENDS ##",
+                "depends+=({})".format(" ".join(extra_deps)))
+            if wrong_arch:
+                pkgbuild_contents = re.sub(
+                    "(?m)^arch=.*$", f"arch=({THIS_ARCH})",
+                    pkgbuild_contents, 1)
             # Remove previous package, repackage, and get new name (arch may
             # have changed).
             fullpath.unlink()
             (cwd / "PKGBUILD").write_text(pkgbuild_contents)
-            _run_shell("makepkg --force --repackage --nodeps", cwd=cwd)
+            _run_shell(["makepkg", "--force", "--repackage", "--nodeps"],
+                       cwd=cwd)
             fullpath = _get_fullpath()
         namcap_pkgbuild_report = _run_shell(
-            "namcap PKGBUILD", cwd=cwd, stdout=PIPE, check=False).stdout
+            ["namcap", "PKGBUILD"], cwd=cwd, stdout=PIPE, check=False).stdout
         # Suppressed namcap warnings (may be better to do this via a namcap
         # option?):
         # - Python dependencies always get misanalyzed; filter them away.
@@ -917,18 +1227,20 @@ class _BasePackage(ABC):
             for line in report.split("\n") if line]
         if re.search(f"^{self.pkgname} E: ", namcap_package_report):
             raise PackagingError("namcap found a problem with the package.")
-        _run_shell("makepkg --printsrcinfo >.SRCINFO", cwd=cwd)
-        type(self).build_cache.append(BuildCacheEntry(
-            self.pkgname, fullpath, options.is_dep, namcap_report))
-        # FIXME Suppress message about redundancy of 'python' dependency.
+        return fullpath, namcap_report
+
+
+_pacman_lock = threading.Lock()
 
 
 class Package(_BasePackage):
-    def __init__(self, ref, options):
+    def __init__(self, ref, options, *, conflicts="${provides%=*}"):
         super().__init__()
 
         self._ref = ref
         self._pkgrel = options.pkgrel
+        # The default is unquoted, to avoid an empty entry.
+        self._conflicts = conflicts
 
         stream = StringIO()
 
@@ -942,20 +1254,25 @@ class Package(_BasePackage):
 
         self._find_makedepends(options)
         for dep in self._makedepends:
-            if _run_shell(f"pacman -Q {dep.pkgname} >/dev/null 2>&1",
-                          check=False).returncode:
-                # Only log this as needed, to not spam messages about pip.
-                _run_shell(f"sudo pacman -S --asdeps {dep.pkgname}",
-                           verbose=True)
+            # Dependencies may be packaged concurrently, but pacman can only
+            # run once at a time.
+            with _pacman_lock:
+                if _run_shell(["pacman", "-Q", dep.pkgname],
+                              stdout=DEVNULL, stderr=DEVNULL,
+                              check=False).returncode:
+                    # Only log this as needed, to not spam messages about pip.
+                    _run_shell(["sudo", "pacman", "-S", "--asdeps",
+                                dep.pkgname],
+                               verbose=True)
         self._extract_setup_requires()
 
         metadata = _get_metadata(
             f"{ref.orig_name}{gen_ver_cmp_operator(self.pkgver)}"
-            if urllib.parse.urlparse(ref.orig_name).scheme == ""
+            if _urlparse(ref.orig_name).scheme == ""
             else ref.orig_name,
             self._makedepends.pep503_names)
         self._depends = DependsTuple(
-            PackageRef(req)
+            _get_package_ref(req)
             if options.build_deps else
             # FIXME Could use something slightly better, i.e. still check local
             # packages...
@@ -986,7 +1303,7 @@ class Package(_BasePackage):
                 sources.append(src_template.format(
                     arch=wheel_info.get_arch_platform(),
                     url=url,
-                    name=Path(urllib.parse.urlparse(url["url"]).path).name))
+                    name=Path(_urlparse(url["url"]).path).name))
         else:
             arches.append("any")
             sources.append(SDIST_SOURCE.format(url=self._urls[0]))
@@ -994,12 +1311,14 @@ class Package(_BasePackage):
         stream.write(
             PKGBUILD_HEADER.format(pkg=self, config=get_makepkg_conf()))
         stream.write("".join(sources))
+        names, md5s = self._get_file_sources()
         stream.write(MORE_SOURCES.format(
-            names=" ".join(shlex.quote(name)
-                           for name in self._files),
-            md5s=" ".join(hashlib.md5(content).hexdigest()
-                          for content in self._files.values())))
-        stream.write(PKGBUILD_CONTENTS)
+            names=" ".join(names), md5s=" ".join(md5s)))
+        dist_name = self._guess_dist_name()
+        stream.write(PKGBUILD_CONTENTS.replace(
+            "    ## DIST_NAME ##\n",
+            DIST_NAME_SHORTCUT.format(dist_name=shlex.quote(dist_name))
+            if dist_name else ""))
 
         self._pkgbuild = stream.getvalue()
 
@@ -1040,11 +1359,25 @@ class Package(_BasePackage):
                 continue
         return [url for url, key in sorted(urls, key=lambda kv: kv[1])]
 
+    def _guess_dist_name(self):
+        # Name of the directory into which makepkg extracts (or clones) the
+        # source, or None for wheels or unknown formats.
+        url = self._urls[0]
+        if url["packagetype"] != "sdist":
+            return None
+        name = Path(_urlparse(url["url"]).path).name
+        if url["url"].startswith("git+"):
+            return re.sub(r"\.git\Z", "", name)
+        for suffix in SDIST_SUFFIXES:
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return None
+
     def _get_first_package_type(self):
         return self._urls[0]["packagetype"]
 
     def _get_sdist_url(self):
-        parsed = urllib.parse.urlparse(self._ref.orig_name)
+        parsed = _urlparse(self._ref.orig_name)
         return (self._ref.orig_name
                 if re.match(r"\A(git\+|file\Z)", parsed.scheme)
                 # pypa/pip#1884: pip download will actually run egg_info, thus
@@ -1055,7 +1388,7 @@ class Package(_BasePackage):
                     self._ref.pypi_name, gen_ver_cmp_operator(self.pkgver)))
 
     def _get_pip_url(self):
-        parsed = urllib.parse.urlparse(self._ref.orig_name)
+        parsed = _urlparse(self._ref.orig_name)
         return (
             self._ref.orig_name
             if re.match(r"\A(git\+|file\Z)", parsed.scheme) else
@@ -1097,7 +1430,7 @@ class Package(_BasePackage):
             elif isinstance(pkg, NonPyPackageRef):
                 pep503_name = _run_shell(
                     f"pacman -Qql {pkg.pkgname} | "
-                    f"grep -Po '(?<=^{_get_site_packages_location()}/)"
+                    f"grep -Po '(?<=^{SITE_PACKAGES_LOCATION}/)"
                     r"[^-]*(?=-.*\.(dist|egg)-info/$)'",
                     stdout=PIPE, check=False).stdout
                 makedepends.append(
@@ -1133,7 +1466,7 @@ class Package(_BasePackage):
         _license_found = False
         if any(license not in TROVE_COMMON_LICENSES for license in licenses):
             for url in [info["download_url"], info["home_page"]]:
-                parsed = urllib.parse.urlparse(url or "")  # Could be None.
+                parsed = _urlparse(url or "")  # Could be None.
                 if len(Path(parsed.path).parts) != 3:  # ["/", user, name]
                     continue
                 # Strip final slash for later manipulations.
@@ -1149,19 +1482,26 @@ class Package(_BasePackage):
                         path=parsed.path + "/raw")
                 else:
                     continue
-                for license_name in LICENSE_NAMES:
+
+                def _fetch_license(license_name, parsed=parsed):
                     try:
-                        r = urllib.request.urlopen(
-                            urllib.parse.urlunparse(
-                                parsed._replace(path=parsed.path + "/master/"
-                                                     + license_name)))
+                        with urllib.request.urlopen(
+                                urllib.parse.urlunparse(parsed._replace(
+                                    path=parsed.path + "/master/"
+                                         + license_name))) as r:
+                            return r.read()
                     except urllib.error.HTTPError:
-                        pass
-                    else:
-                        self._files.update(LICENSE=r.read())
-                        _license_found = True
-                        break
-                if _license_found:
+                        return None
+
+                # Query all candidates at once, but respect their priority.
+                license_contents = next(
+                    (contents for contents
+                     in _map_concurrently(_fetch_license, LICENSE_NAMES)
+                     if contents is not None),
+                    None)
+                if license_contents is not None:
+                    self._add_file("LICENSE", license_contents)
+                    _license_found = True
                     break
             else:
                 try:
@@ -1176,13 +1516,13 @@ class Package(_BasePackage):
                     for path in map(sdist_unpackacked_path.joinpath,
                                     LICENSE_NAMES):
                         if path.is_file():
-                            self._files.update(LICENSE=path.read_bytes())
+                            self._add_file("LICENSE", path.read_bytes())
                             _license_found = True
                             break
             if not _license_found:
-                self._files.update(
-                    LICENSE=("LICENSE: " + ", ".join(licenses) + "\n")
-                            .encode("ascii"))
+                self._add_file(
+                    "LICENSE",
+                    ("LICENSE: " + ", ".join(licenses) + "\n").encode("ascii"))
                 LOGGER.warning("Could not retrieve license file.")
 
         return licenses
@@ -1216,6 +1556,8 @@ class Package(_BasePackage):
         lambda self: self._makedepends)
     checkdepends = property(
         lambda self: DependsTuple())
+    conflicts = property(
+        lambda self: self._conflicts)
 
     @property
     def provides(self):
@@ -1232,10 +1574,12 @@ class Package(_BasePackage):
             return f"{name}={self.pkgver}"
 
     def write_deps_to(self, options):
-        for ref in self._depends:
-            if not ref.exists:
-                # Dependency not found, build it too.
-                create_package(ref.pep503_name, options._replace(is_dep=True))
+        # Dependencies not found are built too, concurrently (each build is
+        # mostly spent waiting on the network or on subprocesses).
+        dep_options = options._replace(is_dep=True)
+        _map_concurrently(
+            lambda ref: create_package(ref.pep503_name, dep_options),
+            [ref for ref in self._depends if not ref.exists])
 
 
 class MetaPackage(_BasePackage):
@@ -1247,14 +1591,10 @@ class MetaPackage(_BasePackage):
         self._subpkgrefs = DependsTuple(
             PackageRef(name, subpkg_of=ref, pre=options.pre)
             for name in ref.arch_packaged)
-        self._subpkgs = [Package(ref, options) for ref in self._subpkgrefs]
-        for pkg in self._subpkgs:
-            pkg._pkgbuild = re.sub(
-                "(?m)^conflicts=.*$",
-                "conflicts=('{0}<{1}' '{0}>{1}')".format(
-                    ref.pkgname, self._arch_version),
-                pkg._pkgbuild,
-                1)
+        conflicts = "'{0}<{1}' '{0}>{1}'".format(
+            ref.pkgname, self._arch_version)
+        self._subpkgs = [Package(ref, options, conflicts=conflicts)
+                         for ref in self._subpkgrefs]
         self._pkgbuild = (
             PKGBUILD_HEADER.format(pkg=self, config=get_makepkg_conf())
             + METAPKGBUILD_CONTENTS)
@@ -1283,6 +1623,8 @@ class MetaPackage(_BasePackage):
         lambda self: DependsTuple())
     provides = property(
         lambda self: "")
+    conflicts = property(
+        lambda self: "")
 
     def _get_target_path(self, base_path):
         return base_path / ("meta:" + self._ref.pkgname)
@@ -1291,26 +1633,50 @@ class MetaPackage(_BasePackage):
         dep_options = options._replace(
             base_path=self._get_target_path(options.base_path),
             is_dep=True)
-        for pkg in self._subpkgs:
+
+        def _write_subpkg(pkg):
             pkg.write_deps_to(dep_options)
             pkg.write_to(dep_options)
 
+        # Subpackages are independent from one another.
+        _map_concurrently(_write_subpkg, self._subpkgs)
+
     def write_to(self, options):
         super().write_to(options._replace(
             base_path=self._get_target_path(options.base_path)))
 
 
+@_locked_cache
+def _get_package_ref(name, *, pre=False, guess_makedepends=()):
+    # Shared by all dependents, so treat the result as immutable.
+    return PackageRef(name, pre=pre, guess_makedepends=guess_makedepends)
+
+
 def dispatch_package_builder(name, options):
-    ref = PackageRef(
+    ref = _get_package_ref(
         name, pre=options.pre, guess_makedepends=options.guess_makedepends)
     if options.pkgname:
+        ref = copy.copy(ref)
         ref.pkgname = options.pkgname
     cls = Package if len(ref.arch_packaged) <= 1 else MetaPackage
     return cls(ref, options)
 
 
-@lru_cache()
+_created_packages = set()
+_created_packages_lock = threading.Lock()
+
+
 def create_package(name, options):
+    # Each package is only created once, even if concurrently required by
+    # multiple dependents.  (Unlike `_locked_cache`, this doesn't wait for the
+    # first creation to complete, which would deadlock on dependency cycles.)
+    # The other options are the same throughout a run, so they don't need to
+    # be hashed.
+    key = name, options.base_path, options.pre, options.is_dep
+    with _created_packages_lock:
+        if key in _created_packages:
+            return
+        _created_packages.add(key)
     pkg = dispatch_package_builder(name, options)
     if options.build_deps:
         pkg.write_deps_to(options)
@@ -1318,21 +1684,18 @@ def create_package(name, options):
 
 
 def find_outdated():
-    syswide_location = (
-        "{0.prefix}/lib/python{0.version_info.major}.{0.version_info.minor}"
-        "/site-packages".format(sys))
+    # json.loads accepts (and decodes) bytes directly.
     outdated = json.loads(
-        _run_shell("pip list --outdated --format=json", stdout=PIPE).stdout)
+        _run_shell(["pip", "list", "--outdated", "--format=json"],
+                   stdout=PIPE, text=False).stdout)
     if not outdated:
         return {}
-    # `pip show` is rather slow, so just call it once.
-    locs = _run_shell(
-        "pip show {} 2>/dev/null | grep -Po '(?<=^Location: ).*'".
-        format(" ".join(row["name"] for row in outdated)),
-        stdout=PIPE).stdout.splitlines()
     owners = {}
-    for row, loc in zip(outdated, locs):
-        if loc == syswide_location:
+    for row in outdated:
+        # Directly look for the metadata in the system-wide location, rather
+        # than asking `pip show` for the package location.
+        if next(importlib.metadata.distributions(
+                name=row["name"], path=[SITE_PACKAGES_LOCATION]), None):
             pkgname, arch_version = _find_installed_name_version(row["name"])
             # Check that pypi's version is indeed newer.  Some packages
             # mis-report their version to pip (e.g., slicerator 0.9.7's Github
@@ -1344,8 +1707,10 @@ def find_outdated():
                     row["name"], row["latest_version"])
                 continue
             owners.setdefault(f"{pkgname} {arch_version}", []).append(row)
+    if not owners:
+        return {}
     owners = OrderedDict(sorted(owners.items()))
-    rows = sum(owners.values(), [])
+    rows = [*chain.from_iterable(owners.values())]
     name_len, ver_len, lver_len, lft_len = (
         max(map(len, (row[key] for row in rows)))
         for key in ["name", "version", "latest_version", "latest_filetype"])
@@ -1480,10 +1845,12 @@ def main():
     for cmd in ["namcap", "pkgfile"]:
         if shutil.which(cmd) is None:
             parser.error(f"Missing dependency: {cmd}")
-    try:
-        _run_shell("pkgfile pkgfile >/dev/null")
-    except CalledProcessError:
-        # "error: No repo files found. Please run `pkgfile --update'."
+    # Check for pkgfile's repo files directly, rather than by running a query
+    # that needs to load the whole database.  Depending on the pkgfile version,
+    # each repo is stored either as `$repo.files` or as `$repo.files.NNN`
+    # chunks.
+    if not any(_get_pkgfile_cache_dir().glob("*.files*")):
+        LOGGER.error("No repo files found.  Please run `pkgfile --update`.")
         sys.exit(1)
 
     outdated, upgrade, ignore, install, pacman_opts = map(
@@ -1499,7 +1866,7 @@ def main():
             parser.error("--upgrade-outdated should be given with no name.")
         ignore = {*map(pep503_normalize_name, ignore)}
         names = {pep503_normalize_name(row["name"])
-                 for row in sum(find_outdated().values(), [])}
+                 for row in chain.from_iterable(find_outdated().values())}
         ignored = ignore & names
         if ignored:
             LOGGER.info("Ignoring upgrade of %s.", ", ".join(sorted(ignored)))
@@ -1520,17 +1887,21 @@ def main():
             LOGGER.error("%s", exc)
             return 1
 
-    print("\n".join(line for cache_entry in Package.build_cache
+    # Packages are built concurrently, thus added to the cache in an arbitrary
+    # order.
+    build_cache = sorted(Package.build_cache,
+                         key=lambda cache_entry: cache_entry.pkgname)
+    print("\n".join(line for cache_entry in build_cache
                     for line in cache_entry.namcap_report))
 
-    if install and Package.build_cache:
+    if install and build_cache:
+        paths, deps = [], []
+        for cache_entry in build_cache:
+            paths.append(shlex.quote(str(cache_entry.path)))
+            if cache_entry.is_dep:
+                deps.append(cache_entry.pkgname)
         cmd = "pacman -U{} {} {}".format(
-            "" if args.build_deps else "dd",
-            pacman_opts,
-            " ".join(shlex.quote(str(cache_entry.path))
-                     for cache_entry in Package.build_cache))
-        deps = [cache_entry.pkgname for cache_entry in Package.build_cache
-                if cache_entry.is_dep]
+            "" if args.build_deps else "dd", pacman_opts, " ".join(paths))
         if deps:
             cmd += "; pacman -D --asdeps {}".format(" ".join(deps))
         cmd = "sudo sh -c {}".format(shlex.quote(cmd))
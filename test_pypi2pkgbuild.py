@@ -1,7 +1,11 @@
+import importlib.metadata
+import json
 from pathlib import Path
 import subprocess
 import sys
 
+from pypi2pkgbuild import _get_package_path, find_outdated
+
 
 _local_path = Path(__file__).parent
 
@@ -23,3 +27,52 @@ def test_build_wheel(tmp_path):
         [sys.executable, str(_local_path / "pypi2pkgbuild.py"),
          "-b", tmp_path, "-n", "file://{}".format(wheel_path)],
         check=True)
+
+
+def test_get_package_path(tmp_path):
+    srcinfo = """\
+pkgbase = python-foo
+\tpkgdesc = Foo.
+\tpkgver = 1.2
+\tpkgrel = 3
+\tarch = {arch}
+\tdepends = python
+{epoch}
+pkgname = python-foo
+"""
+    conf = {"CARCH": "x86_64", "PKGDEST": "", "PKGEXT": ".pkg.tar.zst"}
+    assert (_get_package_path(srcinfo.format(arch="any", epoch=""),
+                              conf, tmp_path)
+            == tmp_path / "python-foo-1.2-3-any.pkg.tar.zst")
+    # Only the first arch is used, and replaced by CARCH if not "any".
+    assert (_get_package_path(
+                srcinfo.format(arch="i686\n\tarch = any", epoch=""),
+                conf, tmp_path)
+            == tmp_path / "python-foo-1.2-3-x86_64.pkg.tar.zst")
+    # A zero epoch is omitted, a nonzero one is prepended to the version.
+    assert (_get_package_path(
+                srcinfo.format(arch="any", epoch="\tepoch = 0"),
+                conf, tmp_path)
+            == tmp_path / "python-foo-1.2-3-any.pkg.tar.zst")
+    assert (_get_package_path(
+                srcinfo.format(arch="any", epoch="\tepoch = 2"),
+                conf, tmp_path)
+            == tmp_path / "python-foo-2:1.2-3-any.pkg.tar.zst")
+    # PKGDEST, if set, overrides the build directory.
+    assert (_get_package_path(
+                srcinfo.format(arch="any", epoch=""),
+                {**conf, "PKGDEST": "/pkgdest"}, tmp_path)
+            == Path("/pkgdest/python-foo-1.2-3-any.pkg.tar.zst"))
+
+
+def test_find_outdated_no_syswide_owner(monkeypatch):
+    # pip reports an outdated package, but it is not installed system-wide.
+    outdated = [{"name": "foo", "version": "1.0", "latest_version": "2.0",
+                 "latest_filetype": "wheel"}]
+    monkeypatch.setattr(
+        "pypi2pkgbuild._run_shell",
+        lambda *args, **kwargs: subprocess.CompletedProcess(
+            args, 0, stdout=json.dumps(outdated).encode()))
+    monkeypatch.setattr(
+        importlib.metadata, "distributions", lambda **kwargs: iter([]))
+    assert find_outdated() == {}